@@ -0,0 +1,145 @@
+import hashlib
+import json
+import logging
+import sqlite3
+
+RECORD_GROUP_FIELDS = ("record_id", "redcap_event_name", "redcap_repeat_instance")
+TRANSFORM_GROUP_FIELDS = ("record_id", "namespace")
+
+
+class TransmitChangeDetector(object):
+    """
+    Keeps a local store of content hashes from the last acknowledged transmit so
+    only changed record groups (record_id, event, instance), changed transform
+    groups (record_id, namespace) and changed metadata blocks are re-sent.
+    Groups that were sent last time but are no longer present are reported as
+    tombstones. has_previous_state is False when no earlier run was loaded
+    (full transmit, an empty store or another project's store), in which case
+    the run is a full snapshot and there are no tombstones. Nothing is written
+    to the store until commit() is called, which should only happen once every
+    chunk has been accepted by the datalake.
+    """
+
+    def __init__(self, store_path, project_id, full_transmit=False):
+        self.store_path = store_path
+        self.project_id = str(project_id)
+        self.conn = sqlite3.connect(store_path)
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS store_info (name TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS group_hashes (
+                kind TEXT, group_key TEXT, digest BLOB, PRIMARY KEY (kind, group_key)
+            );
+            CREATE TABLE IF NOT EXISTS metadata_hashes (name TEXT PRIMARY KEY, digest BLOB);
+            """
+        )
+
+        stored_project_id = self.conn.execute(
+            "SELECT value FROM store_info WHERE name = 'project_id'"
+        ).fetchone()
+        if stored_project_id and stored_project_id[0] != self.project_id:
+            logging.warning(
+                f"Change store {store_path} belongs to project {stored_project_id[0]}, "
+                f"not {self.project_id}. Ignoring stored hashes."
+            )
+            full_transmit = True
+
+        # store_info is only written by commit(), so an empty store has no row
+        self.has_previous_state = bool(stored_project_id) and not full_transmit
+        self.previous_groups = {}
+        self.previous_metadata = {}
+        if self.has_previous_state:
+            for kind, group_key, digest in self.conn.execute(
+                "SELECT kind, group_key, digest FROM group_hashes"
+            ):
+                self.previous_groups.setdefault(kind, {})[group_key] = digest
+            self.previous_metadata = dict(
+                self.conn.execute("SELECT name, digest FROM metadata_hashes")
+            )
+
+        self.current_groups = {}
+        self.current_metadata = {}
+
+    @staticmethod
+    def digest(obj):
+        return hashlib.blake2b(
+            json.dumps(obj, sort_keys=True, default=str).encode("utf-8"),
+            digest_size=16,
+        ).digest()
+
+    def select_changed(self, kind, records, group_fields):
+        """
+        Group records by group_fields and return only the records belonging to
+        groups whose content differs from the last acknowledged run. Every group
+        seen here is remembered for commit() and tombstones().
+        """
+        groups = {}
+        for rec in records:
+            group_key = json.dumps([rec.get(f) for f in group_fields])
+            groups.setdefault(group_key, []).append(rec)
+
+        previous = self.previous_groups.get(kind, {})
+        current = self.current_groups.setdefault(kind, {})
+        changed_records = []
+        for group_key, group_records in groups.items():
+            group_digest = self.digest(
+                sorted(
+                    json.dumps(rec, sort_keys=True, default=str)
+                    for rec in group_records
+                )
+            )
+            current[group_key] = group_digest
+            if previous.get(group_key) != group_digest:
+                changed_records.extend(group_records)
+
+        return changed_records
+
+    def changed_records(self, records):
+        return self.select_changed("redcap_records", records, RECORD_GROUP_FIELDS)
+
+    def changed_transform_records(self, transform_records):
+        return self.select_changed(
+            "transform_records", transform_records, TRANSFORM_GROUP_FIELDS
+        )
+
+    def metadata_changed(self, name, block):
+        block_digest = self.digest(block)
+        self.current_metadata[name] = block_digest
+        return self.previous_metadata.get(name) != block_digest
+
+    def tombstones(self, kind, group_fields):
+        previous = self.previous_groups.get(kind, {})
+        current = self.current_groups.get(kind, {})
+        return [
+            dict(zip(group_fields, json.loads(group_key)))
+            for group_key in previous
+            if group_key not in current
+        ]
+
+    def deleted_record_groups(self):
+        return self.tombstones("redcap_records", RECORD_GROUP_FIELDS)
+
+    def deleted_transform_groups(self):
+        return self.tombstones("transform_records", TRANSFORM_GROUP_FIELDS)
+
+    def commit(self):
+        with self.conn:
+            self.conn.execute("DELETE FROM group_hashes")
+            self.conn.execute("DELETE FROM metadata_hashes")
+            for kind, groups in self.current_groups.items():
+                self.conn.executemany(
+                    "INSERT INTO group_hashes (kind, group_key, digest) VALUES (?, ?, ?)",
+                    ((kind, group_key, digest) for group_key, digest in groups.items()),
+                )
+            self.conn.executemany(
+                "INSERT INTO metadata_hashes (name, digest) VALUES (?, ?)",
+                self.current_metadata.items(),
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO store_info (name, value) VALUES ('project_id', ?)",
+                (self.project_id,),
+            )
+        logging.info(f"Committed transmit change store {self.store_path}")
+
+    def close(self):
+        self.conn.close()
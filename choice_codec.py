@@ -0,0 +1,93 @@
+import hashlib
+import json
+
+import numpy as np
+import pandas as pd
+
+from redcap_metadata import field_choices
+
+# joins field_name and code/label into one lookup key; not \x00, which numpy drops
+KEY_SEPARATOR = "\x1f"
+
+_codecs_by_metadata_hash = {}
+
+
+def metadata_hash(metadata):
+    return hashlib.blake2b(
+        json.dumps(metadata, sort_keys=True).encode("utf-8"), digest_size=16
+    ).hexdigest()
+
+
+class ChoiceCodec(object):
+    """
+    Every radio, dropdown, checkbox, yesno and truefalse field's choices,
+    parsed once from the REDCap metadata into code -> label and label -> code
+    lookup series keyed by field and code/label. Whole columns of values are
+    then decoded or encoded with one vectorized map instead of re-parsing
+    select_choices_or_calculations per value. Use from_metadata to share one
+    codec per metadata version.
+    """
+
+    def __init__(self, metadata):
+        self.choices = {}
+        labels = {}
+        codes = {}
+        for md in metadata:
+            choices = field_choices(md)
+            if choices is None:
+                continue
+            field_name = md.get("field_name")
+            self.choices[field_name] = choices
+            for code, label in choices:
+                labels[f"{field_name}{KEY_SEPARATOR}{code}"] = label
+                codes[f"{field_name}{KEY_SEPARATOR}{label}"] = code
+        self.labels = pd.Series(labels, dtype=object)
+        self.codes = pd.Series(codes, dtype=object)
+
+    @classmethod
+    def from_metadata(cls, metadata):
+        key = metadata_hash(metadata)
+        codec = _codecs_by_metadata_hash.get(key)
+        if codec is None:
+            codec = _codecs_by_metadata_hash[key] = cls(metadata)
+        return codec
+
+    @staticmethod
+    def lookup_keys(field_names, values):
+        # keeps the index of field_names when it is a series
+        index = field_names.index if isinstance(field_names, pd.Series) else None
+        field_names = pd.Series(np.asarray(field_names, dtype=object), index=index)
+        values = pd.Series(np.asarray(values, dtype=object), index=index)
+        return field_names + KEY_SEPARATOR + values.astype(str)
+
+    def decode(self, field_names, codes):
+        """
+        Labels for parallel field name / raw code columns, NaN where the field
+        has no choices or the code is not one of them.
+        """
+        return self.lookup_keys(field_names, codes).map(self.labels)
+
+    def encode(self, field_names, labels):
+        return self.lookup_keys(field_names, labels).map(self.codes)
+
+    def is_valid(self, field_names, codes):
+        return self.lookup_keys(field_names, codes).isin(self.labels.index)
+
+    def decode_column(self, field_name, codes):
+        """
+        Labels for one field's column of raw codes, e.g. a flat export column.
+        """
+        return self.decode([field_name] * len(codes), list(codes))
+
+    def add_labels(self, records, label_key="value_label"):
+        """
+        Add the choice label of every choice field value to the eav records.
+        """
+        labels = self.decode(
+            [rec.get("field_name") for rec in records],
+            [rec.get("value") for rec in records],
+        )
+        for rec, label in zip(records, labels.tolist()):
+            if isinstance(label, str):
+                rec[label_key] = label
+        return records
@@ -5,6 +5,7 @@ import dateutil
 import pandas as pd
 import pandera as pa
 
+from secondary_id import HMACSecondaryIDProvider
 from transform import REDCapETLTransform
 
 
@@ -283,30 +284,39 @@ class InterimSecondaryIDTransform(REDCapETLTransform):
 
     def __init__(self, etl):
         super().__init__(etl)
-        secondary_id_mapping = pd.read_csv(
-            self.etl.config.get("dcc_transforms", "secondary_id_file")
+        config = self.etl.config
+        self.provider = HMACSecondaryIDProvider(
+            key=config.get("dcc_transforms", "secondary_id_key", fallback=None),
+            id_format=config.get(
+                "dcc_transforms", "secondary_id_format", fallback="{code}"
+            ),
+            code_length=config.getint(
+                "dcc_transforms", "secondary_id_length", fallback=10
+            ),
+            cache_file=config.get("dcc_transforms", "secondary_id_file", fallback=None),
         )
-        self.mapping_dict = secondary_id_mapping.set_index(["redcap_record_id"])[
-            "secondary_id"
-        ].to_dict()
-
-    def get_secondary_id(self, record_id):
-        sec_id = self.mapping_dict.get(record_id)
-        return sec_id
 
     def process_records(self):
-
-        seen_record_ids = set()
-        for record in self.etl.records:
-            record_id = record.get("record")
-            if record_id not in seen_record_ids:
-                secondary_id = self.get_secondary_id(record_id)
-                seen_record_ids.add(record_id)
-                self.add_transform_record(record_id, "secondary_id", secondary_id)
-                self.etl.secondary_id_map[record_id] = secondary_id
+        record_ids = dict.fromkeys(
+            record.get("record_id") for record in self.etl.records
+        )
+        secondary_ids = self.provider.get_secondary_ids(record_ids)
+        for record_id, secondary_id in secondary_ids.items():
+            if secondary_id is None:
+                logging.error(f"no secondary_id for {record_id}")
+            self.add_transform_record(record_id, "secondary_id", secondary_id)
+        self.etl.secondary_id_map.update(secondary_ids)
 
         return True
 
+    def finish(self):
+        # shards and pipeline chunks only see some participants, so check here
+        self.provider.check_collisions(self.etl.secondary_id_map)
+
+    def commit(self):
+        # cached ids win over generated ones, so only pin ids that were sent
+        self.provider.save_cache(self.etl.secondary_id_map)
+
     def get_transform_metadata(self):
         return [
             dict(
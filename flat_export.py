@@ -0,0 +1,86 @@
+import io
+import re
+
+import numpy as np
+import pandas as pd
+
+from choice_codec import ChoiceCodec
+
+ID_COLUMNS = ["redcap_event_name", "redcap_repeat_instrument", "redcap_repeat_instance"]
+CHECKED_VALUES = ["1", "Checked"]
+
+
+def checkbox_column_name(field_name, code):
+    # REDCap lower cases checkbox codes and swaps anything else for _ in column names
+    return f"{field_name}___{re.sub(r'[^a-z0-9_]', '_', code.lower())}"
+
+
+class FlatEAVConverter(object):
+    """
+    Converts a type=flat CSV export into the same records get_records builds
+    from a type=eav export: one dict per non-empty value with record_id,
+    redcap_event_name, redcap_repeat_instrument, redcap_repeat_instance,
+    field_name and value. Checked checkbox ___code columns become one record
+    per checked code with the raw code as the value, unchecked ones are
+    dropped, and the record id field is kept on non-repeating rows only, as
+    eav does.
+    """
+
+    def __init__(self, metadata):
+        self.record_id_field = metadata[0].get("field_name")
+        checkbox_fields = {}
+        checkbox_codes = {}
+        choices = ChoiceCodec.from_metadata(metadata).choices
+        for md in metadata:
+            if md.get("field_type") != "checkbox":
+                continue
+            field_name = md.get("field_name")
+            for code, _ in choices[field_name]:
+                column_name = checkbox_column_name(field_name, code)
+                checkbox_fields[column_name] = field_name
+                checkbox_codes[column_name] = code
+        self.checkbox_fields = pd.Series(checkbox_fields, dtype=object)
+        self.checkbox_codes = pd.Series(checkbox_codes, dtype=object)
+
+    def convert(self, csv_text):
+        flat = pd.read_csv(
+            io.StringIO(csv_text), dtype=str, keep_default_na=False, na_filter=False
+        )
+        if flat.empty:
+            return []
+
+        id_columns = [c for c in ID_COLUMNS if c in flat.columns]
+        keys = flat[id_columns].copy()
+        keys.insert(0, "record_id", flat[self.record_id_field])
+
+        values = flat.drop(columns=id_columns)
+        if "redcap_repeat_instrument" in flat.columns:
+            # eav only has the record id field on the non-repeating rows
+            values.loc[
+                flat["redcap_repeat_instrument"] != "", self.record_id_field
+            ] = ""
+        values = values.replace("", np.nan)
+        values.index = pd.MultiIndex.from_frame(keys)
+
+        eav = (
+            values.stack(dropna=True)
+            .rename("value")
+            .rename_axis(index=list(keys.columns) + ["field_name"])
+            .reset_index()
+        )
+
+        is_checkbox = eav["field_name"].isin(self.checkbox_fields.index)
+        if is_checkbox.any():
+            eav = eav[~is_checkbox | eav["value"].isin(CHECKED_VALUES)].copy()
+            is_checkbox = eav["field_name"].isin(self.checkbox_fields.index)
+            checkbox_columns = eav.loc[is_checkbox, "field_name"]
+            eav.loc[is_checkbox, "value"] = checkbox_columns.map(self.checkbox_codes)
+            eav.loc[is_checkbox, "field_name"] = checkbox_columns.map(
+                self.checkbox_fields
+            )
+
+        columns = id_columns + ["field_name", "value", "record_id"]
+        # much quicker than to_dict("records"), which boxes every value
+        return [
+            dict(zip(columns, row)) for row in zip(*(eav[c].tolist() for c in columns))
+        ]
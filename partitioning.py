@@ -0,0 +1,169 @@
+import hashlib
+import logging
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+
+import payload_codec
+from sharding import shard_index
+
+SIZE_UNITS = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+ESTIMATE_SAMPLE_SIZE = 200
+# a partition still too big after this many splits is almost surely one participant
+MAX_SPLIT_LEVEL = 4
+
+
+def parse_size(size):
+    """
+    "512M", "2G" or a plain number of bytes
+    """
+    size = str(size).strip().upper().rstrip("B")
+    if size and size[-1] in SIZE_UNITS:
+        return int(float(size[:-1]) * SIZE_UNITS[size[-1]])
+    return int(size)
+
+
+def estimate_records_bytes(records):
+    """
+    Rough in-memory size of a list of eav record dicts, from a sample.
+    """
+    if not records:
+        return 0
+    step = max(1, len(records) // ESTIMATE_SAMPLE_SIZE)
+    sample = records[::step]
+    sample_bytes = 0
+    for rec in sample:
+        sample_bytes += sys.getsizeof(rec)
+        for value in rec.values():
+            sample_bytes += sys.getsizeof(value)
+    return sys.getsizeof(records) + sample_bytes * len(records) // len(sample)
+
+
+class PartitionStore(object):
+    """
+    On-disk partitions of eav records keyed by a hash of record_id, so every
+    value of a participant lands in the same partition. Each spill appends one
+    pickled, dictionary-encoded (payload schema v2) batch per partition file
+    and adds its estimated in-memory size to the partition. Partitions are read
+    back one at a time; a partition estimated over max_bytes is first split
+    again, batch by batch, into enough smaller partitions to fit.
+    """
+
+    def __init__(self, partition_count=32, directory=None, level=0):
+        self.partition_count = partition_count
+        self.level = level
+        self.directory = tempfile.mkdtemp(
+            prefix="redcap-etl-partitions-", dir=directory
+        )
+        self.spilled_records = 0
+        self.partition_bytes = [0] * partition_count
+
+    def partition_index(self, record_id):
+        if self.level == 0:
+            return shard_index(record_id, self.partition_count)
+        # crc32 is linear, so re-hashing with it would keep a split partition's
+        # records together; salt an unrelated hash with the split level instead
+        digest = hashlib.blake2b(
+            str(record_id).encode("utf-8"), digest_size=8, salt=bytes([self.level])
+        ).digest()
+        return int.from_bytes(digest, "little") % self.partition_count
+
+    def partition_path(self, partition_number):
+        return os.path.join(self.directory, f"partition-{partition_number:04d}.pickle")
+
+    def spill(self, records):
+        partitions = [[] for _ in range(self.partition_count)]
+        for rec in records:
+            partitions[self.partition_index(rec.get("record_id"))].append(rec)
+        for partition_number, partition in enumerate(partitions):
+            if not partition:
+                continue
+            with open(self.partition_path(partition_number), "ab") as partition_file:
+                pickle.dump(
+                    payload_codec.encode_records(partition),
+                    partition_file,
+                    protocol=pickle.HIGHEST_PROTOCOL,
+                )
+            self.partition_bytes[partition_number] += estimate_records_bytes(partition)
+        self.spilled_records += len(records)
+        logging.info(
+            f"Spilled {len(records)} records to {self.directory} "
+            f"({self.spilled_records} total)"
+        )
+
+    def batches(self, partition_number):
+        path = self.partition_path(partition_number)
+        if not os.path.exists(path):
+            return
+        with open(path, "rb") as partition_file:
+            while True:
+                try:
+                    batch = pickle.load(partition_file)
+                except EOFError:
+                    break
+                yield payload_codec.decode_records(batch)
+
+    def load(self, partition_number):
+        records = []
+        for batch in self.batches(partition_number):
+            records.extend(batch)
+        return records
+
+    def split(self, partition_number, max_bytes):
+        """
+        Respill one partition into a child store sized so each of its
+        partitions should fit in max_bytes, one batch at a time.
+        """
+        partition_bytes = self.partition_bytes[partition_number]
+        split_store = PartitionStore(
+            partition_count=2 * (partition_bytes // max_bytes + 1),
+            directory=self.directory,
+            level=self.level + 1,
+        )
+        logging.info(
+            f"Splitting partition {partition_number} (~{partition_bytes} bytes) "
+            f"into {split_store.partition_count} partitions"
+        )
+        for batch in self.batches(partition_number):
+            split_store.spill(batch)
+        os.remove(self.partition_path(partition_number))
+        return split_store
+
+    def can_split(self):
+        # a split that put everything in one partition found a single participant
+        return self.level == 0 or sum(1 for b in self.partition_bytes if b) > 1
+
+    def partitions(self, max_bytes=None):
+        for partition_number in range(self.partition_count):
+            partition_bytes = self.partition_bytes[partition_number]
+            if not partition_bytes:
+                continue
+            if (
+                max_bytes
+                and partition_bytes > max_bytes
+                and self.level < MAX_SPLIT_LEVEL
+                and self.can_split()
+            ):
+                with self.split(partition_number, max_bytes) as split_store:
+                    yield from split_store.partitions(max_bytes)
+                continue
+
+            records = self.load(partition_number)
+            if max_bytes and partition_bytes > max_bytes:
+                # one participant alone is past the budget
+                logging.warning(
+                    f"Partition {partition_number} (~{partition_bytes} bytes) is "
+                    f"over the {max_bytes} byte budget and cannot be split further"
+                )
+            yield records
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
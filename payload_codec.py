@@ -0,0 +1,128 @@
+"""
+Compact (schema version 2) encoding of the redcap_records in a transmit chunk.
+
+Version 1, the default, sends redcap_records as a list of objects:
+
+    [{"record_id": "1-4", "redcap_event_name": "screening_arm_1",
+      "redcap_repeat_instrument": "", "redcap_repeat_instance": "",
+      "field_name": "np_gender", "value": "1"}, ...]
+
+Version 2 is enabled with [datalake] payload_schema_version = 2. The chunk
+then carries payload_schema_version: 2 and redcap_records is an object:
+
+    {
+        "schema_version": 2,
+        "record_count": 2,
+        "record_ids": ["1-4"],
+        "events": ["screening_arm_1"],
+        "instruments": [""],
+        "fields": ["np_gender", "np_race"],
+        "columns": {
+            "record_id": [0, 0],                 # index into record_ids
+            "redcap_event_name": [0, 0],         # index into events
+            "redcap_repeat_instrument": [0, 0],  # index into instruments
+            "redcap_repeat_instance": ["", ""],  # as exported
+            "field_name": [0, 1],                # index into fields
+            "value": ["1", "3"]                  # as exported
+        },
+        "extra_columns": {
+            "kpmp_date_cleaned": [[5, true]]     # [row, value] pairs
+        },
+        "missing_columns": {
+            "redcap_repeat_instrument": [7]      # rows without the key
+        }
+    }
+
+Any other key on a record (for example the kpmp_date_cleaned flags set by
+in-place date shifting) is sent sparsely in extra_columns. A record without
+one of the encoded columns (projects without repeating instruments have no
+redcap_repeat_* keys) gets null in that column and its row listed under the
+column in missing_columns, so the key is left out again when decoding.
+Both blocks may be absent when empty. decode_records is the reference
+decoder and returns exactly the version 1 list.
+"""
+
+PAYLOAD_SCHEMA_VERSION = 2
+
+# column name -> string table name, None for columns sent as-is
+ENCODED_COLUMNS = {
+    "record_id": "record_ids",
+    "redcap_event_name": "events",
+    "redcap_repeat_instrument": "instruments",
+    "redcap_repeat_instance": None,
+    "field_name": "fields",
+    "value": None,
+}
+ENCODED_KEYS = frozenset(ENCODED_COLUMNS)
+
+
+def encode_records(records):
+    tables = {}
+    codes = {}
+    columns = {}
+    for column, table_name in ENCODED_COLUMNS.items():
+        columns[column] = []
+        if table_name:
+            tables[table_name] = []
+            codes[column] = {}
+
+    extra_columns = {}
+    missing_columns = {}
+    for row, rec in enumerate(records):
+        if rec.keys() != ENCODED_KEYS:
+            # only records with missing or extra keys pay for the sparse blocks
+            for column in ENCODED_COLUMNS:
+                if column not in rec:
+                    missing_columns.setdefault(column, []).append(row)
+            for key, value in rec.items():
+                if key not in ENCODED_COLUMNS:
+                    extra_columns.setdefault(key, []).append([row, value])
+        for column, table_name in ENCODED_COLUMNS.items():
+            value = rec.get(column)
+            if table_name:
+                column_codes = codes[column]
+                code = column_codes.get(value)
+                if code is None:
+                    code = column_codes[value] = len(column_codes)
+                    tables[table_name].append(value)
+                value = code
+            columns[column].append(value)
+
+    encoded = dict(schema_version=PAYLOAD_SCHEMA_VERSION, record_count=len(records))
+    encoded.update(tables)
+    encoded["columns"] = columns
+    encoded["extra_columns"] = extra_columns
+    encoded["missing_columns"] = missing_columns
+    return encoded
+
+
+def decode_records(encoded):
+    if encoded.get("schema_version") != PAYLOAD_SCHEMA_VERSION:
+        raise ValueError(
+            f"Unsupported redcap_records schema version {encoded.get('schema_version')}"
+        )
+
+    columns = encoded["columns"]
+    decoded_columns = []
+    for column, table_name in ENCODED_COLUMNS.items():
+        values = columns[column]
+        if table_name:
+            table = encoded[table_name]
+            values = [table[code] for code in values]
+        decoded_columns.append(values)
+
+    column_names = list(ENCODED_COLUMNS.keys())
+    records = [dict(zip(column_names, row)) for row in zip(*decoded_columns)]
+    for key, row_values in encoded.get("extra_columns", {}).items():
+        for row, value in row_values:
+            records[row][key] = value
+    for column, rows in encoded.get("missing_columns", {}).items():
+        for row in rows:
+            del records[row][column]
+    return records
+
+
+def record_count(redcap_records):
+    if isinstance(redcap_records, dict):
+        return redcap_records["record_count"]
+    return len(redcap_records)
@@ -0,0 +1,167 @@
+import bisect
+import csv
+import logging
+import re
+import time
+
+MONTHS = r"(?:jan|feb|mar|apr|may|jun|jul|aug|sep|sept|oct|nov|dec)[a-z]*\.?"
+
+# One combined pattern so every value is scanned in a single pass. None of the
+# alternatives can match the \x00 used to join values, so a match never spans
+# two values.
+PHI_PATTERNS = {
+    "date": (
+        r"\b(?:\d{4}[-/.]\d{1,2}[-/.]\d{1,2}"
+        r"|\d{1,2}[-/.]\d{1,2}[-/.](?:\d{4}|\d{2})"
+        rf"|{MONTHS}[ \t]+\d{{1,2}}(?:st|nd|rd|th)?,?[ \t]+\d{{4}}"
+        rf"|\d{{1,2}}[ \t]+{MONTHS}[ \t]+\d{{4}})\b"
+    ),
+    "mrn": (
+        r"\b(?:mrn|medical[ \t]+record(?:[ \t]+(?:number|no\.?|#))?)"
+        r"[ \t]*[:#]?[ \t]*\d{4,}\b"
+    ),
+    # a whole value of 7-10 digits, off by default as counts and ids match too
+    "bare_mrn": r"(?<![^\x00])\d{7,10}(?![^\x00])",
+    "phone": r"(?:\+?1[ \t.-]?)?(?:\(\d{3}\)|\b\d{3})[ \t.-]?\d{3}[ \t.-]\d{4}\b",
+}
+
+DEFAULT_PHI_PATTERNS = ["date", "mrn", "phone"]
+
+VALUE_SEPARATOR = "\x00"
+
+# transform namespaces holding dates DateVariableTransform already shifted
+CLEANED_NAMESPACES = {"TransformedDate"}
+
+# Every pattern starts with a digit, "(", "+" or a month / "mrn" / "medical"
+# letter at a word boundary. Checking that first lets the regex engine skip
+# most positions without trying each alternative.
+PHI_PATTERN_PREFIX = r"(?=[\d(+jfmasondJFMASOND])(?<![a-zA-Z0-9])"
+
+# The shortest value any pattern can match, e.g. 3/4/21
+MIN_PHI_VALUE_LENGTH = 6
+
+
+def compile_phi_pattern(pattern_names):
+    return re.compile(
+        PHI_PATTERN_PREFIX
+        + "(?:"
+        + "|".join(f"(?P<{name}>{PHI_PATTERNS[name]})" for name in pattern_names)
+        + ")",
+        re.IGNORECASE,
+    )
+
+
+class PHIScanner(object):
+    """
+    Looks for date-like, MRN-like and phone-like values that made it through
+    filter_phi. Values are joined into one string and run through a single
+    precompiled pattern, so the scan cost is one regex pass over the data.
+    Dates cleaned by DateVariableTransform (kpmp_date_cleaned in place or the
+    TransformedDate namespace) and the DAG / form complete fields are not
+    scanned.
+    """
+
+    def __init__(self, pattern_names=None, exempt_fields=None):
+        self.pattern_names = pattern_names or DEFAULT_PHI_PATTERNS
+        self.exempt_fields = set(exempt_fields or [])
+        self.pattern = compile_phi_pattern(self.pattern_names)
+
+    def is_exempt(self, field_name):
+        return (
+            field_name in self.exempt_fields
+            or field_name == "redcap_data_access_group"
+            or field_name.endswith("_complete")
+        )
+
+    def scan(self, records, field_key="field_name", value_key="value"):
+        """
+        Returns a list of violations, one per record/field/pattern, each with
+        the record_id, event, field_name and the name of the pattern that
+        matched. The values themselves are never included.
+        """
+        start_time = time.perf_counter()
+        scanned = []
+        values = []
+        value_count = 0
+        for rec in records:
+            value = rec.get(value_key)
+            if value is None:
+                continue
+            value = str(value)
+            value_count += 1
+            if len(value) < MIN_PHI_VALUE_LENGTH:
+                continue
+            if rec.get("kpmp_date_cleaned", False) is True:
+                continue
+            if rec.get("namespace") in CLEANED_NAMESPACES:
+                continue
+            if self.is_exempt(rec.get(field_key)):
+                continue
+            scanned.append(rec)
+            values.append(value)
+
+        offsets = []
+        position = 0
+        for value in values:
+            offsets.append(position)
+            position += len(value) + 1
+
+        violations = {}
+        for match in self.pattern.finditer(VALUE_SEPARATOR.join(values)):
+            rec = scanned[bisect.bisect_right(offsets, match.start()) - 1]
+            violation = (
+                rec.get("record_id"),
+                rec.get("redcap_event_name", rec.get("namespace")),
+                rec.get(field_key),
+                match.lastgroup,
+            )
+            violations[violation] = True
+
+        elapsed = time.perf_counter() - start_time
+        if value_count:
+            logging.info(
+                f"PHI scan: {value_count} values ({len(values)} candidates) in "
+                f"{elapsed:.3f}s ({value_count / max(elapsed, 1e-9):,.0f} values/s), "
+                f"{len(violations)} violations"
+            )
+
+        return [
+            dict(record_id=rid, event=event, field_name=field_name, pattern=name)
+            for rid, event, field_name, name in violations
+        ]
+
+
+def report_violations(violations, block=True, report_file=None, append=False):
+    """
+    Logs a summary per field, optionally writes the record/field pairs to a
+    CSV report and, when block is set, raises so nothing is transmitted. Set
+    append to add to the report of an earlier chunk of the same run.
+    """
+    if not violations:
+        return
+
+    if report_file:
+        with open(report_file, "a" if append else "w", newline="") as report:
+            writer = csv.DictWriter(
+                report, fieldnames=["record_id", "event", "field_name", "pattern"]
+            )
+            if not append:
+                writer.writeheader()
+            writer.writerows(violations)
+
+    field_counts = {}
+    for violation in violations:
+        key = (violation["field_name"], violation["pattern"])
+        field_counts[key] = field_counts.get(key, 0) + 1
+    for (field_name, pattern_name), count in sorted(field_counts.items()):
+        logging.error(
+            f"PHI scan: {count} {pattern_name}-like values in field {field_name}"
+        )
+    for violation in violations:
+        logging.error(f"PHI scan violation: {violation}")
+
+    if block:
+        raise Exception(
+            f"PHI scan found {len(violations)} un-cleaned date/MRN/phone-like "
+            f"values in {len(field_counts)} field/pattern pairs, not transmitting"
+        )
@@ -0,0 +1,129 @@
+import logging
+import queue
+import threading
+
+_DONE = object()
+
+
+class PipelineCancelled(Exception):
+    pass
+
+
+class StageExecutor(object):
+    """
+    Runs a chain of stages connected by bounded queues. Each stage has its own
+    pool of worker threads and a function that takes one item and returns an
+    iterable of items for the next stage (the output of the last stage is
+    discarded). A full queue blocks the stage feeding it, so at most
+    queue_size items are in flight between any two stages. The first failure
+    in any stage cancels every other stage and is re-raised from run().
+    """
+
+    def __init__(self, queue_size=4, poll_seconds=0.1):
+        self.queue_size = queue_size
+        self.poll_seconds = poll_seconds
+        self.stages = []
+        self.cancelled = threading.Event()
+        self.errors = []
+
+    def add_stage(self, name, func, workers=1):
+        self.stages.append(dict(name=name, func=func, workers=max(1, workers)))
+        return self
+
+    def cancel(self, error):
+        if not self.cancelled.is_set():
+            self.errors.append(error)
+            self.cancelled.set()
+
+    def _put(self, out_queue, item):
+        while not self.cancelled.is_set():
+            try:
+                out_queue.put(item, timeout=self.poll_seconds)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, in_queue):
+        while not self.cancelled.is_set():
+            try:
+                return in_queue.get(timeout=self.poll_seconds)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _finish_stage(self, stage, out_queue, next_workers):
+        with stage["lock"]:
+            stage["running"] -= 1
+            last_worker = stage["running"] == 0
+        if last_worker:
+            logging.info(f"pipeline stage {stage['name']} finished")
+            if out_queue is not None:
+                for _ in range(next_workers):
+                    self._put(out_queue, _DONE)
+
+    def _run_source(self, source, out_queue, next_workers):
+        try:
+            for item in source:
+                if not self._put(out_queue, item):
+                    return
+        except Exception as e:
+            logging.exception("pipeline source failed")
+            self.cancel(e)
+            return
+        for _ in range(next_workers):
+            self._put(out_queue, _DONE)
+
+    def _run_worker(self, stage, in_queue, out_queue, next_workers):
+        try:
+            while True:
+                item = self._get(in_queue)
+                if item is _DONE:
+                    break
+                for out_item in stage["func"](item) or ():
+                    if out_queue is not None and not self._put(out_queue, out_item):
+                        break
+        except Exception as e:
+            logging.exception(f"pipeline stage {stage['name']} failed")
+            self.cancel(e)
+        finally:
+            self._finish_stage(stage, out_queue, next_workers)
+
+    def run(self, source):
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        threads = [
+            threading.Thread(
+                target=self._run_source,
+                args=(source, queues[0], self.stages[0]["workers"]),
+                name="pipeline-source",
+                daemon=True,
+            )
+        ]
+
+        for index, stage in enumerate(self.stages):
+            stage["lock"] = threading.Lock()
+            stage["running"] = stage["workers"]
+            out_queue = None
+            next_workers = 0
+            if index + 1 < len(self.stages):
+                out_queue = queues[index + 1]
+                next_workers = self.stages[index + 1]["workers"]
+            for worker_number in range(stage["workers"]):
+                threads.append(
+                    threading.Thread(
+                        target=self._run_worker,
+                        args=(stage, queues[index], out_queue, next_workers),
+                        name=f"pipeline-{stage['name']}-{worker_number}",
+                        daemon=True,
+                    )
+                )
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if self.errors:
+            raise self.errors[0]
+        if self.cancelled.is_set():
+            raise PipelineCancelled("pipeline was cancelled")
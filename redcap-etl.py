@@ -2,13 +2,32 @@ import argparse
 import configparser
 import csv
 import datetime
+import itertools
 import json
 import logging
+import threading
+import time
 
 import pandas as pd
 import requests
 
 import dcc_transforms as dt
+import payload_codec
+import sharding
+from change_detection import TransmitChangeDetector
+from choice_codec import ChoiceCodec
+from flat_export import FlatEAVConverter
+from partitioning import PartitionStore, estimate_records_bytes, parse_size
+from phi_scanner import PHIScanner, report_violations
+from pipeline import StageExecutor
+from validation import MetadataValidator, merge_summaries
+
+RECORD_CHUNK_SIZE = 50000
+
+
+def chunks(item_list, number_in_chunk):
+    for i in range(0, len(item_list), number_in_chunk):
+        yield item_list[i : i + number_in_chunk]
 
 
 class REDCapETL(object):
@@ -27,6 +46,31 @@ class REDCapETL(object):
         parser.add_argument("-d", "--debug", dest="debug", action="store_true")
         parser.add_argument("-p", "--pub-debug", dest="pub_debug", action="store_true")
         parser.add_argument("-w", "--writeout", dest="output_file")
+        parser.add_argument(
+            "--full-transmit",
+            dest="full_transmit",
+            action="store_true",
+            help="Ignore the change store and transmit every record group",
+        )
+        parser.add_argument(
+            "-j",
+            "--workers",
+            dest="workers",
+            type=int,
+            help="Number of processes for sharded transforms and PHI filtering, "
+            "worth it from about 4 cores on large exports",
+        )
+        parser.add_argument(
+            "--pipelined",
+            dest="pipelined",
+            action="store_true",
+            help="Overlap extract, transform and transmit stages",
+        )
+        parser.add_argument(
+            "--memory-budget",
+            dest="memory_budget",
+            help="Spill records to disk partitions past this size, e.g. 2G",
+        )
 
         self.args = parser.parse_args()
 
@@ -58,6 +102,19 @@ class REDCapETL(object):
                 "Must provide a redcap api token in your config [redcap] api_token"
             )
 
+        self.payload_schema_version = self.config.getint(
+            "datalake", "payload_schema_version", fallback=1
+        )
+        if self.payload_schema_version not in (1, payload_codec.PAYLOAD_SCHEMA_VERSION):
+            logging.error(
+                f"Unsupported [datalake] payload_schema_version "
+                f"{self.payload_schema_version}, must be 1 or 2"
+            )
+            raise Exception(
+                f"Unsupported [datalake] payload_schema_version "
+                f"{self.payload_schema_version}, must be 1 or 2"
+            )
+
         self.transform_records = []
         self.unique_fields = set()
         self.filtered_metadata_list = []
@@ -66,7 +123,17 @@ class REDCapETL(object):
         self.field_map_dict = dict()
         self.secondary_id_map = dict()
         self.field_map_errors = dict()
+        # transforms to commit once the run has been transmitted
+        self.finished_transforms = []
         self.output_file_handle = None
+        self.output_lock = threading.Lock()
+        self.phi_scanner = self.get_phi_scanner()
+        # later scans of the same run append to the report
+        self.phi_report_started = False
+        self.validator = None
+        self.flat_converter = None
+        self.validation_summary = []
+        self.validation_lock = threading.Lock()
 
     def get_records(self, api_token, redcap_project_type, api_filter=None):
         """
@@ -75,14 +142,34 @@ class REDCapETL(object):
         """
         self.records = []
 
+        study_ids = self.get_study_ids()
+        logging.info(f"Loaded {len(study_ids)} total with pt_consent 1")
+
+        # 30-10929 WTF
+        for record_chunk in chunks(study_ids, 100):
+            self.records.extend(self.export_record_chunk(api_token, record_chunk))
+
+        self.patch_dag()
+
+        if self.args.debug:
+            logging.debug(
+                f"complete records at end of get_records (debug): {self.records}"
+            )
+
+    def export_record_chunk(self, api_token, record_chunk):
+        """
+        With [redcap] export_type = flat the much smaller flat CSV is requested
+        and converted to the same eav records client side.
+        """
+        export_type = self.config.get("redcap", "export_type", fallback="eav")
         redcap_request_args = {
             "token": api_token,
             "content": "record",
             "format": "csv",
-            "type": "eav",
+            "type": export_type,
             "rawOrLabel": "raw",
             "rawOrLabelHeaders": "raw",
-            "exportCheckboxLabel": "true",
+            "exportCheckboxLabel": "true" if export_type == "eav" else "false",
             "exportSurveyFields": "false",
             "exportDataAccessGroups": "false",
             "returnFormat": "json",
@@ -93,46 +180,38 @@ class REDCapETL(object):
         if self.args.debug:
             logging.info(f"redcap export_records args: {redcap_request_args}")
 
-        study_ids = self.get_study_ids()
-        logging.info(f"Loaded {len(study_ids)} total with pt_consent 1")
-
-        def chunks(study_id_list, number_in_chunk):
-            for i in range(0, len(study_id_list), number_in_chunk):
-                yield study_id_list[i : i + number_in_chunk]
-
-        # 30-10929 WTF
-        for record_chunk in chunks(study_ids, 100):
-            logging.info(f"Processing chunk: {record_chunk}")
+        logging.info(f"Processing chunk: {record_chunk}")
 
-            record_redcap_request_args = redcap_request_args.copy()
-            counter = 0
-            for rec_id in record_chunk:
-                record_redcap_request_args[f"records[{counter}]"] = rec_id
-                counter = counter + 1
+        counter = 0
+        for rec_id in record_chunk:
+            redcap_request_args[f"records[{counter}]"] = rec_id
+            counter = counter + 1
 
-            try:
-                response = requests.post(
-                    self.redcap_api_url, data=record_redcap_request_args
-                )
-            except requests.exceptions.RequestException as e:
-                raise SystemExit(e)
+        try:
+            response = requests.post(self.redcap_api_url, data=redcap_request_args)
+        except requests.exceptions.RequestException as e:
+            raise SystemExit(e)
 
-            if self.args.debug:
-                logging.debug(f"redcap response: {response} chunk: {record_chunk}")
+        if self.args.debug:
+            logging.debug(f"redcap response: {response} chunk: {record_chunk}")
 
+        parse_start = time.perf_counter()
+        if export_type == "flat":
+            if not self.flat_converter:
+                self.flat_converter = FlatEAVConverter(self.metadata)
+            recs_list = self.flat_converter.convert(response.text)
+        else:
             reader = csv.DictReader(response.text.splitlines())
             recs_list = list(reader)
             for rec in recs_list:
                 rec["record_id"] = rec.pop("record")
 
-            self.records.extend(recs_list)
-
-        self.patch_dag()
-
-        if self.args.debug:
-            logging.debug(
-                f"complete records at end of get_records (debug): {self.records}"
-            )
+        logging.info(
+            f"Exported {len(response.content)} bytes ({export_type}) as "
+            f"{len(recs_list)} records, parsed in "
+            f"{time.perf_counter() - parse_start:.3f}s"
+        )
+        return recs_list
 
     def get_study_ids(self):
         api_filter = self.config.get("redcap", "api_filter", fallback=None)
@@ -163,8 +242,14 @@ class REDCapETL(object):
     def patch_dag(self):
 
         # Add dag in as additional field in eav
+        self.records.extend(self.dag_eav_records())
+
+    def dag_eav_records(self, study_ids=None):
+        dag_eav_records = []
         for rec in self.dag_records:
-            self.records.append(
+            if study_ids is not None and rec.get("study_id") not in study_ids:
+                continue
+            dag_eav_records.append(
                 dict(
                     record_id=rec.get("study_id"),
                     redcap_event_name=rec.get("redcap_event_name"),
@@ -174,6 +259,7 @@ class REDCapETL(object):
                     value=rec.get("redcap_data_access_group"),
                 )
             )
+        return dag_eav_records
 
     def get_metadata(self):
 
@@ -186,6 +272,33 @@ class REDCapETL(object):
         redcap_api_result = requests.post(self.redcap_api_url, redcap_api_data)
         self.metadata = redcap_api_result.json()
 
+        if self.config.getboolean("validation", "enabled", fallback=True):
+            self.validator = MetadataValidator(self.metadata)
+
+    def validate_records(self, records):
+        """
+        Check exported values against the field types, validation rules and
+        choices in the REDCap metadata. Violations are collected in
+        validation_summary and reported by report_validation. Returns the
+        violations found in these records.
+        """
+        if not self.validator:
+            return []
+        summary = self.validator.validate(records)
+        with self.validation_lock:
+            self.validation_summary = merge_summaries(self.validation_summary, summary)
+        return summary
+
+    def report_validation(self):
+        for violation in self.validation_summary:
+            logging.warning(f"Validation: {violation}")
+        if self.validation_summary and self.config.getboolean(
+            "validation", "block", fallback=False
+        ):
+            raise Exception(
+                f"Validation failed for {len(self.validation_summary)} field/rule pairs"
+            )
+
     def get_project_info(self):
 
         redcap_api_data = {
@@ -215,81 +328,154 @@ class REDCapETL(object):
 
     def write_out(self, json_data):
         logging.info(f"Writing out to file: {self.args.output_file}")
-        if not self.output_file_handle:
-            self.output_file_handle = open(self.args.output_file, "x")
-        self.output_file_handle.write(json_data)
-        self.output_file_handle.write("\n")
+        with self.output_lock:
+            if not self.output_file_handle:
+                self.output_file_handle = open(self.args.output_file, "x")
+            self.output_file_handle.write(json_data)
+            self.output_file_handle.write("\n")
+
+    def get_change_detector(self):
+        change_store = self.config.get("datalake", "change_store", fallback=None)
+        if not change_store:
+            return None
+        return TransmitChangeDetector(
+            change_store,
+            self.redcap_project_id,
+            full_transmit=self.args.full_transmit,
+        )
+
+    def add_metadata_blocks(self, result, detector=None):
+        metadata_blocks = dict(
+            redcap_metadata_filtered=self.filtered_metadata(),
+            transform_metadata=self.transform_metadata,
+        )
+        for block_name, block in metadata_blocks.items():
+            if detector and not detector.metadata_changed(block_name, block):
+                result.setdefault("unchanged_metadata_blocks", []).append(block_name)
+            else:
+                result[block_name] = block
 
     def transmit(self):
 
-        record_chunk_size = 50000
-        record_chunks = [
-            self.records[i : i + record_chunk_size]
-            for i in range(0, len(self.records), record_chunk_size)
-        ]
-        chunk_number = 1
         run_datetime = datetime.datetime.now().isoformat()
+
+        records = self.records
+        transform_records = self.transform_records
+        detector = self.get_change_detector()
+        if detector:
+            records = detector.changed_records(self.records)
+            transform_records = detector.changed_transform_records(
+                self.transform_records
+            )
+            logging.info(
+                f"Change detection: {len(records)} of {len(self.records)} records and "
+                f"{len(transform_records)} of {len(self.transform_records)} "
+                f"transform records changed since the last transmit"
+            )
+
+        record_chunks = chunks(records, RECORD_CHUNK_SIZE)
+        if detector and not records:
+            # still send a chunk so transform changes and tombstones go out
+            record_chunks = [[]]
+        chunk_number = 1
+
+        for record_chunk in record_chunks:
+            result = self.new_chunk(chunk_number, run_datetime, record_chunk)
+            if chunk_number == 1:
+                self.add_run_blocks(result, transform_records, detector)
+
+            self.post_chunk(result)
+
+            chunk_number += 1
+
+        if detector:
+            # only remember what the datalake has actually acknowledged
+            if not self.args.fake:
+                detector.commit()
+            detector.close()
+        self.commit_transforms()
+
+    def new_chunk(self, chunk_number, run_datetime, record_chunk):
+        result = dict(
+            chunk_number=chunk_number,
+            redcap_project_id=self.redcap_project_id,
+            redcap_project_type=self.redcap_project_type,
+            extraction_run_datetime=run_datetime,
+            redcap_records=record_chunk,
+        )
+        if self.config.getboolean("datalake", "include_choice_labels", fallback=False):
+            ChoiceCodec.from_metadata(self.metadata).add_labels(record_chunk)
+        if self.payload_schema_version == payload_codec.PAYLOAD_SCHEMA_VERSION:
+            result["payload_schema_version"] = self.payload_schema_version
+            result["redcap_records"] = payload_codec.encode_records(record_chunk)
+        return result
+
+    def add_run_blocks(self, result, transform_records, detector=None):
+        """
+        Add the once-per-run blocks (transform records, metadata and change
+        detection tombstones) to a chunk.
+        """
         include_metadata = self.config.getboolean(
             "redcap", "include_metadata", fallback=False
         )
-
-        for record_chunk in record_chunks:
-            result = dict(
-                chunk_number=chunk_number,
-                redcap_project_id=self.redcap_project_id,
-                redcap_project_type=self.redcap_project_type,
-                extraction_run_datetime=run_datetime,
-                redcap_records=record_chunk,
+        result["transform_records"] = transform_records
+        if include_metadata:
+            self.add_metadata_blocks(result, detector)
+        if detector:
+            # a full run replaces the project snapshot, as nothing was compared
+            result["transmit_mode"] = "delta" if detector.has_previous_state else "full"
+            result["deleted_record_groups"] = detector.deleted_record_groups()
+            result["deleted_transform_groups"] = detector.deleted_transform_groups()
+
+    def post_chunk(self, result):
+        chunk_number = result["chunk_number"]
+        record_chunk = result["redcap_records"]
+
+        json_result = json.dumps(result)
+        json_metadata = json.dumps(result.get("redcap_metadata_filtered"))
+        transform_json = json.dumps(result.get("transform_records"))
+
+        if self.args.fake:
+            logging.info(
+                f"Would transmit {chunk_number}. Total size {len(json_result)}"
+                f" metadata: {len(json_metadata)} transform {len(transform_json)}"
             )
-            if chunk_number == 1:
-                result["transform_records"] = self.transform_records
-                if include_metadata:
-                    result["redcap_metadata_filtered"] = self.filtered_metadata()
-                    result["transform_metadata"] = self.transform_metadata
+            logging.info(
+                f"Length of records: {payload_codec.record_count(record_chunk)}"
+            )
+            # logging.info(json_result)
+            if self.args.output_file:
+                self.write_out(json.dumps(result))
+        else:
+            try:
+                api_endpoint = self.config.get("datalake", "api_endpoint")
+                # api_token = self.config.get('datalake','api_token')
+            except Exception as e:
+                raise SystemExit(e)
 
-            json_result = json.dumps(result)
-            json_metadata = json.dumps(result.get("redcap_metadata_filtered"))
-            transform_json = json.dumps(result.get("transform_records"))
+            # reuse the encoding done above instead of json=result
+            r = requests.post(
+                url=api_endpoint,
+                data=json_result,
+                headers={"Content-Type": "application/json"},
+                # If incomplete chain, verify="fix-upload-cert.pem"
+            )
 
-            if self.args.fake:
-                logging.info(
-                    f"Would transmit {chunk_number}. Total size {len(json_result)}"
-                    f" metadata: {len(json_metadata)} transform {len(transform_json)}"
+            if not r:
+                logging.error(
+                    f"Failed to transmit data. Got: {r} {r.content} to {api_endpoint} for chunk {chunk_number}"
                 )
-                logging.info(f"Length of records: {len(record_chunk)}")
-                # logging.info(json_result)
-                if self.args.output_file:
-                    self.write_out(json.dumps(result))
-            else:
-                try:
-                    api_endpoint = self.config.get("datalake", "api_endpoint")
-                    # api_token = self.config.get('datalake','api_token')
-                except Exception as e:
-                    raise SystemExit(e)
-
-                r = requests.post(
-                    url=api_endpoint,
-                    json=result
-                    # If incomplete chain, verify="fix-upload-cert.pem"
+                raise Exception(
+                    f"Failed to transmit data. Got: {r} {r.content} to {api_endpoint} for {chunk_number}"
                 )
 
-                if not r:
-                    logging.error(
-                        f"Failed to transmit data. Got: {r} {r.content} to {api_endpoint} for chunk {chunk_number}"
-                    )
-                    raise Exception(
-                        f"Failed to transmit data. Got: {r} {r.content} to {api_endpoint} for {chunk_number}"
-                    )
-
-                else:
-                    logging.info(
-                        f"successfully posted chunk: {chunk_number} data to "
-                        f"{api_endpoint} response: {r} content {r.content}"
-                    )
-                    logging.info(json_result)
-                    logging.info(f"response content: {r.content}")
-
-            chunk_number += 1
+            else:
+                logging.info(
+                    f"successfully posted chunk: {chunk_number} data to "
+                    f"{api_endpoint} response: {r} content {r.content}"
+                )
+                logging.info(json_result)
+                logging.info(f"response content: {r.content}")
 
     def load_field_map(self):
         self.field_map = pd.read_csv(self.config.get("default", "field_map_file"))
@@ -301,8 +487,7 @@ class REDCapETL(object):
         # nonphi_fields_df['exclude'] = True
         # nonphi_fields_dict = nonphi_fields_df.set_index(['event','field'])['exclude'].to_dict()
 
-        # sanity checks to do
-        # look for datelike field values (regex) that have not been cleaned
+        # datelike field values that have not been cleaned are caught in scan_phi
 
         new_records = []
         for rec in self.records:
@@ -355,29 +540,70 @@ class REDCapETL(object):
 
         self.records = new_records
 
-    def do_transforms(self):
+    def get_phi_scanner(self):
+        if not self.config.getboolean("phi_scan", "enabled", fallback=True):
+            return None
+        pattern_names = self.config.get("phi_scan", "patterns", fallback="")
+        exempt_fields = self.config.get("phi_scan", "exempt_fields", fallback="")
+        return PHIScanner(
+            pattern_names=[p.strip() for p in pattern_names.split(",") if p.strip()],
+            exempt_fields=[f.strip() for f in exempt_fields.split(",") if f.strip()],
+        )
+
+    def scan_phi(self, records, transform_records=None):
+        """
+        Blocks the run if any kept value still looks like a date, MRN or phone
+        number. In pipelined mode earlier chunks may already have been posted,
+        but the final chunk is never sent. Scan before change detection, so
+        unchanged values are checked too.
+        """
+        if not self.phi_scanner:
+            return
+        violations = self.phi_scanner.scan(records)
+        if transform_records:
+            violations.extend(
+                self.phi_scanner.scan(transform_records, value_key="field_value")
+            )
+        report_file = self.config.get("phi_scan", "report_file", fallback=None)
+        report_violations(
+            violations,
+            block=self.config.getboolean("phi_scan", "block", fallback=True),
+            report_file=report_file,
+            append=self.phi_report_started,
+        )
+        if violations and report_file:
+            self.phi_report_started = True
+
+    def get_transforms(self):
+        transforms = [dt.DateVariableTransform(self)]
 
-        trans = dt.DateVariableTransform(self)
-        if trans:
+        if self.config.has_option(
+            "dcc_transforms", "secondary_id_key"
+        ) or self.config.has_option("dcc_transforms", "secondary_id_file"):
+            transforms.append(dt.InterimSecondaryIDTransform(self))
+
+        transforms.append(dt.CalcVariableTransform(self))
+
+        # transforms.append(TestCalcVariableTransform(self))
+        return transforms
+
+    def do_transforms(self, transforms=None):
+        if transforms is None:
+            transforms = self.get_transforms()
+
+        for trans in transforms:
             trans.process_records()
             self.transform_records.extend(trans.get_transform_records())
             self.transform_metadata[
                 trans.data_namespace
             ] = trans.get_transform_metadata()
+            trans.finish()
+            self.finished_transforms.append(trans)
 
-        # t1 = dt.InterimSecondaryIDTransform(self)
-        # if t1:
-        #     t1.process_records()
-        #     self.transform_records.extend(t1.get_transform_records())
-        #     self.transform_metadata[t1.data_namespace] = t1.get_transform_metadata()
-
-        t2 = dt.CalcVariableTransform(self)
-        if t2:
-            t2.process_records()
-            self.transform_records.extend(t2.get_transform_records())
-            self.transform_metadata[t2.data_namespace] = t2.get_transform_metadata()
-
-        # self.transform_records.extend(TestCalcVariableTransform().process_records(self))
+    def get_worker_count(self):
+        if self.args.workers:
+            return self.args.workers
+        return self.config.getint("default", "workers", fallback=1)
 
     def debug_pub(self):
         # print(self.transform_records)
@@ -396,28 +622,238 @@ class REDCapETL(object):
         df = pd.DataFrame(trans_list)
         df.to_csv("debug-public.csv", index=False)
 
-    def run(self):
-        self.init()
-        self.get_project_info()
-        self.get_metadata()
-        api_filter = self.config.get("redcap", "api_filter", fallback=None)
+    def run_pipelined(self):
+        """
+        Extract, transform/filter and transmit at the same time. Chunks of study
+        ids flow from REDCap export workers through transform/PHI filter workers
+        to upload workers over bounded queues. Record chunks are posted as soon
+        as they fill up. The transform records, metadata and tombstones go in a
+        last chunk flagged final_chunk, posted once every other chunk has been
+        accepted.
+        """
+        transforms = self.get_transforms()
+        self.start_streamed_transmit(transforms)
 
-        self.get_records(
-            api_token=self.redcap_api_token,
-            redcap_project_type="KPMP_MAIN",
-            api_filter=api_filter,
+        study_ids = self.get_study_ids()
+        logging.info(f"Loaded {len(study_ids)} total with pt_consent 1")
+        validation_blocks = self.config.getboolean(
+            "validation", "block", fallback=False
         )
 
-        self.load_field_map()
-        #
-        self.do_transforms()
+        def export_stage(study_id_chunk):
+            records = self.export_record_chunk(self.redcap_api_token, study_id_chunk)
+            if self.validate_records(records) and validation_blocks:
+                # fail here so the pipeline cancels before more chunks are posted
+                self.report_validation()
+            records.extend(self.dag_eav_records(set(study_id_chunk)))
+            yield records
+
+        def transform_stage(records):
+            yield shard_pool.transform(records)
+
+        def batch_stage(shard_result):
+            # only one batch worker, so add_shard_result needs no locking
+            yield from self.add_shard_result(shard_result)
+
+        def upload_stage(result):
+            self.post_chunk(result)
+
+        executor = StageExecutor(
+            queue_size=self.config.getint("pipeline", "queue_size", fallback=4)
+        )
+        executor.add_stage(
+            "export",
+            export_stage,
+            self.config.getint("pipeline", "export_workers", fallback=2),
+        )
+        # -j wins over the config, as in get_worker_count
+        transform_workers = self.args.workers or self.config.getint(
+            "pipeline", "transform_workers", fallback=self.get_worker_count()
+        )
+        executor.add_stage("transform", transform_stage, transform_workers)
+        executor.add_stage("batch", batch_stage, 1)
+        executor.add_stage(
+            "upload",
+            upload_stage,
+            self.config.getint("pipeline", "upload_workers", fallback=2),
+        )
+
+        # fork the transform processes before any pipeline threads exist
+        with sharding.ShardPool(self, transforms, transform_workers) as shard_pool:
+            executor.run(chunks(study_ids, 100))
+
+        self.report_validation()
+        self.finish_streamed_transmit(transforms)
+
+    def start_streamed_transmit(self, transforms):
+        """
+        Set up transmitting record chunks as shards or partitions finish, used
+        by the pipelined and memory budgeted modes.
+        """
+        self.records = []
+        self.run_datetime = datetime.datetime.now().isoformat()
+        self.chunk_numbers = itertools.count(1)
+        self.streamed_transform_records = [[] for _ in transforms]
+        self.detector = self.get_change_detector()
+
+    def add_shard_result(self, shard_result):
+        """
+        Merge one transformed and filtered shard or partition, returning every
+        full record chunk that is now ready to post. Not thread safe.
+        """
+        self.scan_phi(shard_result["records"])
+        if self.detector:
+            shard_result["records"] = self.detector.changed_records(
+                shard_result["records"]
+            )
+        sharding.merge_shard_result(self, shard_result, self.streamed_transform_records)
+
+        ready_chunks = []
+        while len(self.records) >= RECORD_CHUNK_SIZE:
+            record_chunk = self.records[:RECORD_CHUNK_SIZE]
+            del self.records[:RECORD_CHUNK_SIZE]
+            ready_chunks.append(
+                self.new_chunk(
+                    next(self.chunk_numbers), self.run_datetime, record_chunk
+                )
+            )
+        return ready_chunks
+
+    def finish_streamed_transmit(self, transforms):
+        """
+        Post the remaining records with the transform records, metadata and
+        tombstones in a last chunk flagged final_chunk.
+        """
+        sharding.finish_transforms(self, transforms, self.streamed_transform_records)
+        self.scan_phi([], self.transform_records)
+        final_transform_records = self.transform_records
+        if self.detector:
+            final_transform_records = self.detector.changed_transform_records(
+                self.transform_records
+            )
+
+        result = self.new_chunk(
+            next(self.chunk_numbers), self.run_datetime, self.records
+        )
+        result["final_chunk"] = True
+        self.add_run_blocks(result, final_transform_records, self.detector)
+        self.post_chunk(result)
+
+        if self.detector:
+            # only remember what the datalake has actually acknowledged
+            if not self.args.fake:
+                self.detector.commit()
+            self.detector.close()
+        self.commit_transforms()
+
+    def commit_transforms(self):
+        if self.args.fake:
+            return
+        for trans in self.finished_transforms:
+            trans.commit()
+
+    def get_memory_budget(self):
+        memory_budget = self.args.memory_budget or self.config.get(
+            "default", "memory_budget", fallback=None
+        )
+        if not memory_budget:
+            return None
+        return parse_size(memory_budget)
 
-        # always restrict to the safe phi free list last
-        self.filter_phi()
+    def run_partitioned(self, memory_budget):
+        """
+        Export into memory until the records pass memory_budget bytes, then
+        spill them to on-disk partitions keyed by record_id. Partitions larger
+        than the budget are split again when read back. Each partition is
+        transformed, filtered and transmitted on its own. With -j N up to N
+        partitions are in the worker pool at once, so each is kept to 1/N of
+        the budget.
+        """
+        study_ids = self.get_study_ids()
+        logging.info(f"Loaded {len(study_ids)} total with pt_consent 1")
+
+        with PartitionStore(
+            partition_count=self.config.getint(
+                "default", "memory_partitions", fallback=32
+            ),
+            directory=self.config.get("default", "spill_dir", fallback=None),
+        ) as store:
+            self.records = []
+            for record_chunk in chunks(study_ids, 100):
+                records = self.export_record_chunk(self.redcap_api_token, record_chunk)
+                self.validate_records(records)
+                self.records.extend(records)
+                self.records.extend(self.dag_eav_records(set(record_chunk)))
+                if estimate_records_bytes(self.records) > memory_budget:
+                    store.spill(self.records)
+                    self.records = []
+            self.report_validation()
+
+            if not store.spilled_records:
+                logging.info("Export fits in the memory budget, processing in memory")
+                self.transform_and_transmit()
+                return
+
+            store.spill(self.records)
+            self.records = []
+            transforms = self.get_transforms()
+            self.start_streamed_transmit(transforms)
+            workers = self.get_worker_count()
+            with sharding.ShardPool(self, transforms, workers) as shard_pool:
+                partitions = store.partitions(memory_budget // workers)
+                for shard_result in shard_pool.transform_all(partitions):
+                    for result in self.add_shard_result(shard_result):
+                        self.post_chunk(result)
+            self.finish_streamed_transmit(transforms)
+
+    def transform_and_transmit(self):
+        workers = self.get_worker_count()
+        start_time = time.perf_counter()
+        if workers > 1:
+            sharding.process_sharded(self, self.get_transforms(), workers)
+        else:
+            self.do_transforms()
+
+            # always restrict to the safe phi free list last
+            self.filter_phi()
+        # compare with -j 1 to see whether the workers pay off on this host
+        logging.info(
+            f"Transformed and filtered to {len(self.records)} records in "
+            f"{time.perf_counter() - start_time:.2f}s with {workers} workers"
+        )
 
         # logging.info(f'post filter phi {len(self.records)}')
 
+        self.scan_phi(self.records, self.transform_records)
+
         self.transmit()
+
+    def run(self):
+        self.init()
+        self.get_project_info()
+        self.get_metadata()
+        self.load_field_map()
+
+        memory_budget = self.get_memory_budget()
+        if self.args.pipelined or self.config.getboolean(
+            "pipeline", "enabled", fallback=False
+        ):
+            self.run_pipelined()
+        elif memory_budget:
+            self.run_partitioned(memory_budget)
+        else:
+            api_filter = self.config.get("redcap", "api_filter", fallback=None)
+
+            self.get_records(
+                api_token=self.redcap_api_token,
+                redcap_project_type="KPMP_MAIN",
+                api_filter=api_filter,
+            )
+            self.validate_records(self.records)
+            self.report_validation()
+
+            self.transform_and_transmit()
+
         if self.args.pub_debug:
             self.debug_pub()
 
@@ -0,0 +1,33 @@
+CHOICE_FIELD_TYPES = ["radio", "dropdown", "checkbox"]
+
+IMPLIED_CHOICES = {
+    "yesno": [("1", "Yes"), ("0", "No")],
+    "truefalse": [("1", "True"), ("0", "False")],
+}
+
+
+def parse_choices(choices_string):
+    """
+    Parse a REDCap select_choices_or_calculations string such as
+    "1, Male | 2, Female" into [(code, label), ...]
+    """
+    choices = []
+    if not choices_string:
+        return choices
+    for choice in choices_string.split("|"):
+        code, _, label = choice.partition(",")
+        code = code.strip()
+        if code:
+            choices.append((code, label.strip()))
+    return choices
+
+
+def field_choices(field_metadata):
+    """
+    The (code, label) choices for a radio, dropdown, checkbox, yesno or
+    truefalse field, None for every other field type.
+    """
+    field_type = field_metadata.get("field_type")
+    if field_type in CHOICE_FIELD_TYPES:
+        return parse_choices(field_metadata.get("select_choices_or_calculations"))
+    return IMPLIED_CHOICES.get(field_type)
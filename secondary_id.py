@@ -0,0 +1,85 @@
+import base64
+import csv
+import hashlib
+import hmac
+import logging
+import os
+
+
+class HMACSecondaryIDProvider(object):
+    """
+    Secondary IDs derived from the REDCap record id with a keyed HMAC, so any
+    participant gets the same ID on every run without a mapping file. IDs from
+    an optional mapping cache (the old secondary_id_file, redcap_record_id and
+    secondary_id columns) take precedence, which keeps legacy IDs stable.
+    Without a key only cached IDs are returned.
+    """
+
+    def __init__(self, key=None, id_format="{code}", code_length=10, cache_file=None):
+        self.key = key.encode("utf-8") if key else None
+        self.id_format = id_format
+        self.code_length = code_length
+        self.cache_file = cache_file
+        self.cached_ids = {}
+
+        if cache_file and os.path.exists(cache_file):
+            with open(cache_file, newline="") as cache:
+                for row in csv.DictReader(cache):
+                    self.cached_ids[row["redcap_record_id"]] = row["secondary_id"]
+
+    def generate_id(self, record_id):
+        digest = hmac.new(
+            self.key, str(record_id).encode("utf-8"), hashlib.sha256
+        ).digest()
+        code = base64.b32encode(digest).decode("ascii")[: self.code_length]
+        return self.id_format.format(code=code)
+
+    def get_secondary_ids(self, record_ids):
+        """
+        Returns {record_id: secondary_id} for every record id given. Call
+        check_collisions once every participant of the run has an id.
+        """
+        secondary_ids = {}
+        for record_id in record_ids:
+            secondary_id = self.cached_ids.get(record_id)
+            if secondary_id is None and self.key:
+                secondary_id = self.generate_id(record_id)
+            secondary_ids[record_id] = secondary_id
+        return secondary_ids
+
+    def check_collisions(self, secondary_ids):
+        """
+        Fails if two participants, in secondary_ids or the mapping cache, end
+        up with the same secondary id.
+        """
+        all_ids = dict(self.cached_ids)
+        all_ids.update(secondary_ids)
+        assigned = [sid for sid in all_ids.values() if sid is not None]
+        if len(set(assigned)) != len(assigned):
+            raise Exception(
+                "Secondary ID collision, increase secondary_id_length or change "
+                "secondary_id_format"
+            )
+
+    def save_cache(self, secondary_ids):
+        """
+        Append newly generated IDs to the mapping cache, if there is one.
+        """
+        if not self.cache_file:
+            return
+        new_ids = {
+            record_id: secondary_id
+            for record_id, secondary_id in secondary_ids.items()
+            if secondary_id is not None and record_id not in self.cached_ids
+        }
+        if not new_ids:
+            return
+
+        write_header = not os.path.exists(self.cache_file)
+        with open(self.cache_file, "a", newline="") as cache:
+            writer = csv.writer(cache)
+            if write_header:
+                writer.writerow(["redcap_record_id", "secondary_id"])
+            writer.writerows(new_ids.items())
+        self.cached_ids.update(new_ids)
+        logging.info(f"Added {len(new_ids)} secondary ids to {self.cache_file}")
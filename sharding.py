@@ -0,0 +1,215 @@
+import collections
+import copy
+import logging
+import multiprocessing
+import zlib
+
+# Set just before the worker pool is forked so the children inherit the ETL
+# object, the field map and the transforms (deid table etc) without pickling them.
+_shard_state = None
+
+
+def shard_index(record_id, shard_count):
+    return zlib.crc32(str(record_id).encode("utf-8")) % shard_count
+
+
+def partition_records(records, shard_count):
+    """
+    Split records into shard_count lists keyed by a stable hash of record_id, so
+    every record of a participant (including np_dob) lands in the same shard.
+    """
+    shards = [[] for _ in range(shard_count)]
+    for rec in records:
+        shards[shard_index(rec.get("record_id"), shard_count)].append(rec)
+    return shards
+
+
+def transform_shard(etl, transforms, records):
+    """
+    Run every transform and the PHI filter over a subset of records using a
+    shallow copy of the ETL object, so none of the shared state is modified.
+
+    The kept records come back as record_refs: the index into records of each
+    kept record, or the record itself when a transform added keys or changed
+    its value in place (in-place date shifting) or created it. The caller
+    still holds records, so resolve_records rebuilds the list without
+    pickling every kept record back from a worker.
+    """
+    positions = {id(rec): i for i, rec in enumerate(records)}
+    fingerprints = [(len(rec), rec.get("value")) for rec in records]
+
+    shard_etl = copy.copy(etl)
+    shard_etl.records = records
+    shard_etl.transform_records = []
+    shard_etl.unique_fields = set()
+    shard_etl.field_map_errors = dict()
+    shard_etl.secondary_id_map = dict()
+
+    transform_records = []
+    for trans in transforms:
+        shard_trans = copy.copy(trans)
+        shard_trans.etl = shard_etl
+        shard_trans.transform_records = []
+        shard_trans.process_records()
+        transform_records.append(shard_trans.get_transform_records())
+
+    # always restrict to the safe phi free list last
+    shard_etl.filter_phi()
+
+    record_refs = []
+    for rec in shard_etl.records:
+        i = positions.get(id(rec))
+        if i is None or fingerprints[i] != (len(rec), rec.get("value")):
+            record_refs.append(rec)
+        else:
+            record_refs.append(i)
+
+    return dict(
+        record_refs=record_refs,
+        transform_records=transform_records,
+        unique_fields=shard_etl.unique_fields,
+        field_map_errors=shard_etl.field_map_errors,
+        secondary_id_map=shard_etl.secondary_id_map,
+    )
+
+
+def resolve_records(records, shard_result):
+    """
+    Swap the record_refs of a transform_shard result for the kept records.
+    """
+    shard_result["records"] = [
+        records[ref] if isinstance(ref, int) else ref
+        for ref in shard_result.pop("record_refs")
+    ]
+    return shard_result
+
+
+def merge_shard_result(etl, shard_result, transform_records):
+    etl.records.extend(shard_result["records"])
+    for trans_records, shard_trans_records in zip(
+        transform_records, shard_result["transform_records"]
+    ):
+        trans_records.extend(shard_trans_records)
+    etl.unique_fields.update(shard_result["unique_fields"])
+    for field_name, error in shard_result["field_map_errors"].items():
+        etl.field_map_errors.setdefault(field_name, error)
+    etl.secondary_id_map.update(shard_result["secondary_id_map"])
+
+
+def finish_transforms(etl, transforms, transform_records):
+    for trans, trans_records in zip(transforms, transform_records):
+        etl.transform_records.extend(trans_records)
+        etl.transform_metadata[trans.data_namespace] = trans.get_transform_metadata()
+        trans.finish()
+        etl.finished_transforms.append(trans)
+
+
+def _process_shard(shard_number):
+    etl, transforms, shards = _shard_state
+    return transform_shard(etl, transforms, shards[shard_number])
+
+
+def process_sharded(etl, transforms, workers):
+    """
+    Equivalent of etl.do_transforms() followed by etl.filter_phi(), with the
+    records partitioned by record_id across a pool of forked worker processes.
+    """
+    global _shard_state
+
+    if "fork" not in multiprocessing.get_all_start_methods():
+        logging.warning("fork is not available, running transforms in one process")
+        etl.do_transforms(transforms)
+        etl.filter_phi()
+        return
+
+    # a few shards per worker keeps the pool busy when participants vary in size
+    shards = partition_records(etl.records, workers * 4)
+    logging.info(
+        f"Processing {len(etl.records)} records in {len(shards)} shards "
+        f"with {workers} workers"
+    )
+
+    _shard_state = (etl, transforms, shards)
+    try:
+        with multiprocessing.get_context("fork").Pool(processes=workers) as pool:
+            shard_results = pool.map(_process_shard, range(len(shards)))
+    finally:
+        _shard_state = None
+
+    etl.records = []
+    transform_records = [[] for _ in transforms]
+    for shard, shard_result in zip(shards, shard_results):
+        merge_shard_result(etl, resolve_records(shard, shard_result), transform_records)
+    finish_transforms(etl, transforms, transform_records)
+
+    logging.info(f"Sharded processing kept {len(etl.records)} records")
+
+
+def _transform_records(records):
+    etl, transforms, _ = _shard_state
+    return transform_shard(etl, transforms, records)
+
+
+class ShardPool(object):
+    """
+    Forked process pool for transforming record chunks as they arrive, used
+    by the pipelined executor and by memory budgeted partitioning. Like
+    process_sharded, the workers inherit the ETL object and transforms; only
+    the chunk records going in and the record_refs coming back are pickled.
+    """
+
+    def __init__(self, etl, transforms, workers):
+        self.etl = etl
+        self.transforms = transforms
+        self.workers = workers
+        self.pool = None
+
+    def __enter__(self):
+        global _shard_state
+
+        if self.workers > 1 and "fork" in multiprocessing.get_all_start_methods():
+            _shard_state = (self.etl, self.transforms, None)
+            self.pool = multiprocessing.get_context("fork").Pool(processes=self.workers)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global _shard_state
+
+        if self.pool is not None:
+            if exc_type is None:
+                self.pool.close()
+            else:
+                self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        _shard_state = None
+
+    def transform(self, records):
+        if self.pool is None:
+            shard_result = transform_shard(self.etl, self.transforms, records)
+        else:
+            shard_result = self.pool.apply(_transform_records, (records,))
+        return resolve_records(records, shard_result)
+
+    def transform_all(self, record_batches):
+        """
+        Transform batches across the pool, yielding results in order. Only one
+        batch per worker is in flight, unlike Pool.imap which would read every
+        batch from record_batches up front.
+        """
+        if self.pool is None:
+            for records in record_batches:
+                yield self.transform(records)
+            return
+
+        in_flight = collections.deque()
+        for records in record_batches:
+            if len(in_flight) >= self.workers:
+                records_sent, async_result = in_flight.popleft()
+                yield resolve_records(records_sent, async_result.get())
+            in_flight.append(
+                (records, self.pool.apply_async(_transform_records, (records,)))
+            )
+        while in_flight:
+            records_sent, async_result = in_flight.popleft()
+            yield resolve_records(records_sent, async_result.get())
@@ -37,3 +37,17 @@ class REDCapETLTransform(ABC):
     @abstractmethod
     def get_transform_metadata(self):
         pass
+
+    def finish(self):
+        """
+        Called once in the main process after every record has been processed,
+        including when records were processed in shards.
+        """
+        pass
+
+    def commit(self):
+        """
+        Called once every chunk has been posted, never on fake runs. Persist
+        any state here rather than in finish.
+        """
+        pass
@@ -0,0 +1,178 @@
+import logging
+import time
+
+import pandas as pd
+
+from choice_codec import ChoiceCodec
+
+NUMERIC_VALIDATIONS = [
+    "integer",
+    "number",
+    "number_1dp",
+    "number_2dp",
+    "number_3dp",
+    "number_4dp",
+]
+
+# Raw exports always use the ymd ordering whatever the entry format is
+DATE_VALIDATIONS = {
+    "date_ymd": "%Y-%m-%d",
+    "date_mdy": "%Y-%m-%d",
+    "date_dmy": "%Y-%m-%d",
+    "datetime_ymd": "%Y-%m-%d %H:%M",
+    "datetime_mdy": "%Y-%m-%d %H:%M",
+    "datetime_dmy": "%Y-%m-%d %H:%M",
+    "datetime_seconds_ymd": "%Y-%m-%d %H:%M:%S",
+    "datetime_seconds_mdy": "%Y-%m-%d %H:%M:%S",
+    "datetime_seconds_dmy": "%Y-%m-%d %H:%M:%S",
+    "time": "%H:%M",
+    "time_mm_ss": "%M:%S",
+}
+
+MAX_EXAMPLE_RECORD_IDS = 5
+
+
+def to_number(value):
+    if value is None or value == "":
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+class MetadataValidator(object):
+    """
+    Compiles the REDCap metadata (field_type, text validation type, min/max and
+    choices) into lookup tables once, then checks a whole EAV frame at a time:
+    one to_numeric over every numeric value, one to_datetime per date format
+    and one isin for every choice value, rather than a check per value.
+    """
+
+    def __init__(self, metadata):
+        numeric_fields = {}
+        integer_fields = []
+        date_fields = {}
+        self.choice_codec = ChoiceCodec.from_metadata(metadata)
+        for md in metadata:
+            field_name = md.get("field_name")
+            validation = md.get("text_validation_type_or_show_slider_number")
+            field_type = md.get("field_type")
+
+            if field_name in self.choice_codec.choices:
+                continue
+            if field_type == "slider" or validation in NUMERIC_VALIDATIONS:
+                low = to_number(md.get("text_validation_min"))
+                high = to_number(md.get("text_validation_max"))
+                if field_type == "slider":
+                    low = 0 if low is None else low
+                    high = 100 if high is None else high
+                numeric_fields[field_name] = (low, high)
+                if validation == "integer":
+                    integer_fields.append(field_name)
+            elif validation in DATE_VALIDATIONS:
+                date_fields[field_name] = DATE_VALIDATIONS[validation]
+
+        self.numeric_min = pd.Series(
+            {f: low for f, (low, _) in numeric_fields.items()}, dtype=float
+        )
+        self.numeric_max = pd.Series(
+            {f: high for f, (_, high) in numeric_fields.items()}, dtype=float
+        )
+        self.integer_fields = pd.Index(integer_fields)
+        self.date_formats = pd.Series(date_fields, dtype=object)
+        self.choice_fields = pd.Index(list(self.choice_codec.choices), dtype=object)
+
+    def validate(self, records):
+        """
+        Returns a list of violation summaries, one per field and rule, with the
+        number of failing values and a few example record ids.
+        """
+        start_time = time.perf_counter()
+        eav = pd.DataFrame.from_records(
+            records, columns=["record_id", "field_name", "value"]
+        )
+        eav = eav[eav["value"].notna() & (eav["value"] != "")]
+        # a few hundred distinct field names, so isin/map work on the codes
+        eav["field_name"] = eav["field_name"].astype("category")
+        failures = []
+
+        numeric = eav[eav["field_name"].isin(self.numeric_min.index)]
+        if not numeric.empty:
+            numbers = pd.to_numeric(numeric["value"], errors="coerce")
+            low = numeric["field_name"].map(self.numeric_min)
+            high = numeric["field_name"].map(self.numeric_max)
+            failures.append(numeric[numbers.isna()].assign(rule="not_a_number"))
+            failures.append(numeric[numbers < low].assign(rule="below_min"))
+            failures.append(numeric[numbers > high].assign(rule="above_max"))
+
+            is_integer_field = numeric["field_name"].isin(self.integer_fields)
+            not_integer = numbers.notna() & (numbers % 1 != 0) | numeric[
+                "value"
+            ].str.contains(".", regex=False)
+            failures.append(
+                numeric[is_integer_field & not_integer].assign(rule="not_an_integer")
+            )
+
+        dates = eav[eav["field_name"].isin(self.date_formats.index)]
+        if not dates.empty:
+            date_formats = dates["field_name"].map(self.date_formats).astype(object)
+            for date_format, formatted in dates.groupby(date_formats):
+                parsed = pd.to_datetime(
+                    formatted["value"], format=date_format, errors="coerce"
+                )
+                failures.append(formatted[parsed.isna()].assign(rule="bad_date_format"))
+
+        choices = eav[eav["field_name"].isin(self.choice_fields)]
+        if not choices.empty:
+            is_valid = self.choice_codec.is_valid(
+                choices["field_name"], choices["value"]
+            )
+            failures.append(choices[~is_valid].assign(rule="bad_choice"))
+
+        summary = []
+        failures = [f for f in failures if not f.empty]
+        if failures:
+            failed = pd.concat(failures)
+            failed["field_name"] = failed["field_name"].astype(object)
+            for (field_name, rule), failed_group in failed.groupby(
+                ["field_name", "rule"]
+            ):
+                summary.append(
+                    dict(
+                        field_name=field_name,
+                        rule=rule,
+                        count=len(failed_group),
+                        example_record_ids=list(
+                            failed_group["record_id"].unique()[:MAX_EXAMPLE_RECORD_IDS]
+                        ),
+                    )
+                )
+
+        elapsed = time.perf_counter() - start_time
+        logging.info(
+            f"Validation: {len(eav)} values in {elapsed:.3f}s "
+            f"({len(eav) / max(elapsed, 1e-9):,.0f} values/s), "
+            f"{len(summary)} field/rule violations"
+        )
+        return summary
+
+
+def merge_summaries(summary, more_summary):
+    by_key = {}
+    for item in summary + more_summary:
+        key = (item["field_name"], item["rule"])
+        if key not in by_key:
+            by_key[key] = dict(
+                item, example_record_ids=list(item["example_record_ids"])
+            )
+            continue
+        existing = by_key[key]
+        existing["count"] += item["count"]
+        example_record_ids = existing["example_record_ids"]
+        for record_id in item["example_record_ids"]:
+            if len(example_record_ids) >= MAX_EXAMPLE_RECORD_IDS:
+                break
+            if record_id not in example_record_ids:
+                example_record_ids.append(record_id)
+    return list(by_key.values())